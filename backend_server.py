@@ -8,7 +8,16 @@ DATABASE_PASS = os.getenv("DATABASE_PASS", "applepass")
 DATABASE_HOST = os.getenv("DATABASE_HOST", "db")
 DATABASE_PORT = os.getenv("DATABASE_PORT", "5432")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "appledb")
-DATABASE_URL = f"postgresql://{DATABASE_USER}:{DATABASE_PASS}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}"
+DATABASE_PATH = os.getenv("DATABASE_PATH", "data/wristwise.duckdb")
+
+from models.db import DATABASE_BACKEND
+
+if DATABASE_BACKEND == "duckdb":
+    # Embedded DuckDB file, queried through the duckdb-engine SQLAlchemy dialect
+    os.makedirs(os.path.dirname(DATABASE_PATH) or ".", exist_ok=True)
+    DATABASE_URL = f"duckdb:///{DATABASE_PATH}"
+else:
+    DATABASE_URL = f"postgresql://{DATABASE_USER}:{DATABASE_PASS}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}"
 app = Flask(__name__, static_folder='frontend', static_url_path='')
 app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URL
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
@@ -16,6 +25,7 @@ app.config["MAX_CONTENT_LENGTH"] = 600 * 1024 * 1024  # 600 MB limit
 
 # Import db and initialize with app
 from models.db import db
+from models.schema import init_schema
 
 db.init_app(app)
 
@@ -33,18 +43,28 @@ def serve_frontend():
 def serve_static(filename):
     return send_from_directory('frontend', filename)
 
-# Create database tables if they don't exist
-with app.app_context():
-    try:
-        db.create_all()
-        print("Database tables created successfully")
-    except Exception as e:
-        print(f"Error creating database tables: {e}")
+# Schema setup runs once per deploy via `flask --app backend_server init-db`
+# (start.sh does this before Gunicorn forks), not in every worker at import
+@app.cli.command("init-db")
+def init_db_command():
+    """Create tables and apply schema upgrades"""
+    init_schema()
+
+
+@app.cli.command("warm-up")
+def warm_up_command():
+    """Run each analytics endpoint once so the database cache is hot"""
+    client = app.test_client()
+    for rule in app.url_map.iter_rules():
+        if rule.rule.startswith("/analytics/") and "GET" in rule.methods:
+            response = client.get(rule.rule)
+            print(f"Warmed {rule.rule}: {response.status_code}")
+
 
 if __name__ == "__main__":
     try:
         with app.app_context():
-            db.create_all()
+            init_schema()
             db.session.execute(text("SELECT 1"))
         app.run(debug=True, host="0.0.0.0", port=8000)
     except Exception as e:
@@ -1,5 +1,7 @@
 // API Configuration
 const API_BASE_URL = 'http://localhost:8000';
+const UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024; // 8MB per chunk
+const INGEST_POLL_INTERVAL = 2000; // ms between ingest status checks
 
 // DOM Elements
 const apiStatusEl = document.getElementById('api-status');
@@ -119,33 +121,16 @@ async function uploadFile(file) {
     // Show progress
     showUploadProgress();
     
-    // Create form data
-    const formData = new FormData();
-    formData.append('file', file);
-    
     try {
-        // Simulate progress (since we can't track real progress with fetch)
-        simulateProgress();
+        const result = await uploadFileInChunks(file);
+        showUploadResult(true, result.message);
+        loadDataCounts(); // Refresh counts
         
-        const response = await fetch(`${API_BASE_URL}/upload`, {
-            method: 'POST',
-            body: formData
-        });
-        
-        if (response.ok) {
-            const result = await response.json();
-            showUploadResult(true, result.message);
-            loadDataCounts(); // Refresh counts
-            
-            // Refresh analytics after successful upload
-            if (window.healthAnalytics) {
-                setTimeout(() => {
-                    window.healthAnalytics.init();
-                }, 1000);
-            }
-        } else {
-            const errorText = await response.text();
-            showUploadResult(false, `Upload failed: ${errorText}`);
+        // Refresh analytics after successful upload
+        if (window.healthAnalytics) {
+            setTimeout(() => {
+                window.healthAnalytics.init();
+            }, 1000);
         }
     } catch (error) {
         showUploadResult(false, `Upload failed: ${error.message}`);
@@ -154,6 +139,105 @@ async function uploadFile(file) {
     }
 }
 
+// Upload a file through a resumable upload session, one chunk at a time.
+// The session id is remembered per file so a retry or page reload resumes
+// from the last byte (and last ingested record) the server has.
+async function uploadFileInChunks(file) {
+    const storageKey = `upload:${file.name}:${file.size}:${file.lastModified}`;
+    let session = await resumeUploadSession(localStorage.getItem(storageKey));
+    
+    if (!session) {
+        session = await requestJson(`${API_BASE_URL}/upload/sessions`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, total_size: file.size })
+        });
+        localStorage.setItem(storageKey, session.upload_id);
+    }
+    
+    // The server ingests in the background; poll until it finishes, and
+    // restart it from its checkpoint if the worker running it died
+    const sessionUrl = `${API_BASE_URL}/upload/sessions/${session.upload_id}`;
+    const startIngest = () => withRetries(() => requestJson(`${sessionUrl}/complete`, { method: 'POST' }, [409]));
+    let resumedAfterFailure = false;
+    while (session.status !== 'complete') {
+        if (session.status === 'failed') {
+            // A worker exiting mid-ingest also reports failed, so resume once
+            // from the checkpoint before giving up
+            if (!resumedAfterFailure) {
+                resumedAfterFailure = true;
+                session = await startIngest();
+                continue;
+            }
+            // Start a fresh session next time instead of resuming one that keeps failing
+            localStorage.removeItem(storageKey);
+            throw new Error(session.error || 'Processing failed');
+        }
+        if (session.status === 'uploading') {
+            // Send any missing bytes (also after complete finds the server's
+            // copy short), then start the ingest
+            let offset = session.received_bytes;
+            while (offset < file.size && session.status === 'uploading') {
+                const chunk = file.slice(offset, offset + UPLOAD_CHUNK_SIZE);
+                session = await withRetries(() => requestJson(
+                    `${sessionUrl}/chunk?offset=${offset}`,
+                    { method: 'PUT', body: chunk },
+                    [409]
+                ));
+                offset = session.received_bytes;
+                updateProgress(offset / file.size * 90, `Uploading... ${Math.round(offset / file.size * 100)}%`);
+            }
+            session = await startIngest();
+            continue;
+        }
+        updateProgress(95, `Processing records... ${formatNumber(session.records_ingested)} saved`);
+        await new Promise(resolve => setTimeout(resolve, INGEST_POLL_INTERVAL));
+        session = await withRetries(() => requestJson(sessionUrl));
+        if (session.stalled) {
+            session = await startIngest();
+        }
+    }
+    localStorage.removeItem(storageKey);
+    updateProgress(100, 'Done');
+    return { message: `Successfully ingested ${formatNumber(session.records_ingested)} records.` };
+}
+
+// Look up a previous upload session; returns null if it can't be resumed
+async function resumeUploadSession(uploadId) {
+    if (!uploadId) return null;
+    try {
+        const session = await requestJson(`${API_BASE_URL}/upload/sessions/${uploadId}`);
+        return ['complete', 'failed'].includes(session.status) ? null : session;
+    } catch (error) {
+        return null;
+    }
+}
+
+// Fetch JSON, throwing on error statuses except those listed in okStatuses
+// (a 409 on a chunk carries the server's received_bytes to resume from)
+async function requestJson(url, options = {}, okStatuses = []) {
+    const response = await fetch(url, options);
+    const body = await response.json().catch(() => ({}));
+    if (!response.ok && !okStatuses.includes(response.status)) {
+        const error = new Error(body.error || `HTTP ${response.status}`);
+        error.status = response.status;
+        throw error;
+    }
+    return body;
+}
+
+// Retry network failures and server errors with a growing delay
+async function withRetries(request, attempts = 5) {
+    for (let attempt = 1; ; attempt++) {
+        try {
+            return await request();
+        } catch (error) {
+            if (attempt >= attempts || (error.status && error.status < 500)) throw error;
+            await new Promise(resolve => setTimeout(resolve, attempt * 2000));
+        }
+    }
+}
+
 // Show upload progress
 function showUploadProgress() {
     uploadProgress.style.display = 'block';
@@ -167,20 +251,10 @@ function hideUploadProgress() {
     uploadProgress.style.display = 'none';
 }
 
-// Simulate upload progress
-function simulateProgress() {
-    let progress = 0;
-    const interval = setInterval(() => {
-        progress += Math.random() * 15;
-        if (progress > 90) progress = 90;
-        
-        progressFill.style.width = `${progress}%`;
-        progressText.textContent = `Uploading... ${Math.round(progress)}%`;
-        
-        if (progress >= 90) {
-            clearInterval(interval);
-        }
-    }, 500);
+// Update upload progress bar
+function updateProgress(percent, message) {
+    progressFill.style.width = `${percent}%`;
+    progressText.textContent = message;
 }
 
 // Show upload result
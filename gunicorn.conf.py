@@ -0,0 +1,22 @@
+# Gunicorn hooks, loaded by start.sh with --config
+
+
+def post_fork(server, worker):
+    # With --preload the app and its SQLAlchemy engine are built once in the
+    # master; drop any pooled connections inherited across fork so each
+    # worker opens its own (close=False leaves the master's sockets alone)
+    from backend_server import app
+    from models.db import db
+
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def worker_exit(server, worker):
+    # Background ingests die with the worker (e.g. on --max-requests
+    # recycling); mark them failed so clients resume them immediately
+    from backend_server import app
+    from routes.upload import stop_ingests
+
+    with app.app_context():
+        stop_ingests()
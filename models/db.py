@@ -1,3 +1,8 @@
+import os
 from flask_sqlalchemy import SQLAlchemy
 
+# Storage backend: "postgres" (default) or "duckdb" for an embedded,
+# single-node analytical store with no external database service
+DATABASE_BACKEND = os.getenv("DATABASE_BACKEND", "postgres").lower()
+
 db = SQLAlchemy()
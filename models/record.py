@@ -1,10 +1,12 @@
-from models.db import db
+from models.db import db, DATABASE_BACKEND
 
 
 class Record(db.Model):
     __tablename__ = "records"
 
-    id = db.Column(db.Integer, primary_key=True)
+    # Explicit sequences: DuckDB has no SERIAL, and on Postgres these names
+    # match the sequences SERIAL already created
+    id = db.Column(db.Integer, db.Sequence("records_id_seq"), primary_key=True)
     user_id = db.Column(db.Integer)
     type = db.Column(db.Text, nullable=False)
     unit = db.Column(db.Text)
@@ -15,12 +17,24 @@ class Record(db.Model):
     creation_date = db.Column(db.DateTime)
     start_date = db.Column(db.DateTime, nullable=False)
     end_date = db.Column(db.DateTime, nullable=False)
+    # Calendar day and UTC offset of start_date as recorded on the device, so
+    # day-level filters are plain range predicates on an indexed column
+    local_date = db.Column(db.Date)
+    utc_offset_minutes = db.Column(db.Integer)
+
+    __table_args__ = (
+        db.Index("ix_records_type_local_date", "type", "local_date"),
+    )
 
 
 class RecordMetadata(db.Model):
     __tablename__ = "record_metadata"
 
-    id = db.Column(db.Integer, primary_key=True)
-    record_id = db.Column(db.Integer, db.ForeignKey("records.id", ondelete="CASCADE"))
+    id = db.Column(db.Integer, db.Sequence("record_metadata_id_seq"), primary_key=True)
+    # DuckDB does not support cascading foreign keys
+    record_id = db.Column(
+        db.Integer,
+        db.ForeignKey("records.id", ondelete=None if DATABASE_BACKEND == "duckdb" else "CASCADE"),
+    )
     key = db.Column(db.Text)
     value = db.Column(db.Text)
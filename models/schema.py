@@ -0,0 +1,52 @@
+import time
+from sqlalchemy import text
+from models.db import db
+from models.record import Record
+from models.sleep import SLEEP_TYPE, SleepSession, rebuild_sleep_sessions
+
+# Importing the model modules above registers every table with db.metadata
+import models.upload  # noqa: F401
+
+
+def init_schema(retries=10, delay=2):
+    """Create tables and apply in-place upgrades; run once per deploy, not per worker.
+
+    Retries while the database is still starting (e.g. right after
+    docker-compose brings up the db container).
+    """
+    for attempt in range(1, retries + 1):
+        try:
+            db.create_all()
+            break
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print(f"Database not ready ({e}), retrying in {delay}s...")
+            db.session.rollback()
+            time.sleep(delay)
+
+    # Add and backfill the local_date columns on databases created before
+    # they existed; older rows fall back to the stored start_date's day with
+    # a zero offset, so local_date always equals the day of start_date + offset.
+    # Ingest always sets both, so the full-table UPDATE only runs the one time
+    # the columns are added rather than on every deploy
+    columns = set(db.session.execute(text(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = 'records'"
+    )).scalars())
+    if not {"local_date", "utc_offset_minutes"} <= columns:
+        db.session.execute(text("ALTER TABLE records ADD COLUMN IF NOT EXISTS local_date DATE"))
+        db.session.execute(text("ALTER TABLE records ADD COLUMN IF NOT EXISTS utc_offset_minutes INTEGER"))
+        db.session.execute(text("UPDATE records SET local_date = CAST(start_date AS DATE), utc_offset_minutes = 0 WHERE local_date IS NULL"))
+        db.session.commit()  # DuckDB can't build an index with outstanding updates
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS ix_records_type_local_date ON records (type, local_date)"))
+    db.session.commit()
+
+    # Build sleep sessions for data ingested before they were precomputed
+    has_sessions = db.session.query(SleepSession.id).first() is not None
+    has_sleep = db.session.query(Record.id).filter(Record.type == SLEEP_TYPE).first() is not None
+    if has_sleep and not has_sessions:
+        sessions = rebuild_sleep_sessions()
+        print(f"Backfilled {sessions} sleep sessions")
+
+    print("Database tables created successfully")
@@ -0,0 +1,169 @@
+from datetime import timedelta
+from models.db import db
+from models.record import Record
+
+SLEEP_TYPE = "HKCategoryTypeIdentifierSleepAnalysis"
+
+IN_BED = "HKCategoryValueSleepAnalysisInBed"
+AWAKE = "HKCategoryValueSleepAnalysisAwake"
+ASLEEP_STAGES = {
+    "HKCategoryValueSleepAnalysisAsleep": "unspecified",
+    "HKCategoryValueSleepAnalysisAsleepUnspecified": "unspecified",
+    "HKCategoryValueSleepAnalysisAsleepCore": "core",
+    "HKCategoryValueSleepAnalysisAsleepDeep": "deep",
+    "HKCategoryValueSleepAnalysisAsleepREM": "rem",
+}
+
+# A night runs from noon to noon, so a session that starts after midnight
+# still belongs to the evening it began on
+NIGHT_OFFSET = timedelta(hours=12)
+
+
+class SleepSession(db.Model):
+    __tablename__ = "sleep_sessions"
+
+    id = db.Column(db.Integer, db.Sequence("sleep_sessions_id_seq"), primary_key=True)
+    night = db.Column(db.Date, nullable=False, unique=True, index=True)
+    source_name = db.Column(db.Text)
+    start_date = db.Column(db.DateTime, nullable=False)
+    end_date = db.Column(db.DateTime, nullable=False)
+    in_bed_minutes = db.Column(db.Float, nullable=False, default=0)
+    asleep_minutes = db.Column(db.Float, nullable=False, default=0)
+    awake_minutes = db.Column(db.Float, nullable=False, default=0)
+    core_minutes = db.Column(db.Float, nullable=False, default=0)
+    deep_minutes = db.Column(db.Float, nullable=False, default=0)
+    rem_minutes = db.Column(db.Float, nullable=False, default=0)
+    segment_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+def night_of(start_date, utc_offset_minutes=None):
+    """Return the night (local date the evening started) a sleep segment belongs to.
+
+    Pass either a timezone-aware datetime in the device's local time, or a
+    stored UTC start_date together with its utc_offset_minutes.
+    """
+    if utc_offset_minutes is not None:
+        start_date += timedelta(minutes=utc_offset_minutes)
+    return (start_date.replace(tzinfo=None) - NIGHT_OFFSET).date()
+
+
+def merge_intervals(intervals):
+    """Merge overlapping or touching (start, end) intervals in one sorted pass"""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _minutes(intervals):
+    return sum((end - start).total_seconds() for start, end in intervals) / 60
+
+
+def _source_rank(source_name, segments):
+    """Rank a source for one night: staged data first, then the most asleep time.
+
+    Apple Watch writes Core/Deep/REM stages while the phone and most third-party
+    apps only write InBed or plain Asleep, so a source with stages wins.
+    """
+    asleep = [(s, e) for value, s, e in segments if value in ASLEEP_STAGES]
+    has_stages = any(ASLEEP_STAGES.get(value) in ("core", "deep", "rem") for value, _, _ in segments)
+    return (has_stages, _minutes(merge_intervals(asleep)), source_name or "")
+
+
+def build_session(night, segments_by_source):
+    """Build a SleepSession for one night from {source_name: [(value, start, end)]}"""
+    # In-bed time is the union across every source, since phones often only
+    # record InBed while the watch records stages
+    in_bed = merge_intervals(
+        (s, e) for segments in segments_by_source.values() for _, s, e in segments
+    )
+    if not in_bed:
+        return None
+
+    # Asleep/stage time comes from a single source so overlapping sources
+    # are never double counted
+    best_source = max(
+        segments_by_source,
+        key=lambda name: _source_rank(name, segments_by_source[name]),
+    )
+    segments = segments_by_source[best_source]
+
+    stages = {"unspecified": [], "core": [], "deep": [], "rem": []}
+    awake = []
+    for value, start, end in segments:
+        if value in ASLEEP_STAGES:
+            stages[ASLEEP_STAGES[value]].append((start, end))
+        elif value == AWAKE:
+            awake.append((start, end))
+
+    asleep = merge_intervals(
+        interval for intervals in stages.values() for interval in intervals
+    )
+
+    return SleepSession(
+        night=night,
+        source_name=best_source,
+        start_date=in_bed[0][0],
+        end_date=in_bed[-1][1],
+        in_bed_minutes=round(_minutes(in_bed), 1),
+        asleep_minutes=round(_minutes(asleep), 1),
+        awake_minutes=round(_minutes(merge_intervals(awake)), 1),
+        core_minutes=round(_minutes(merge_intervals(stages["core"])), 1),
+        deep_minutes=round(_minutes(merge_intervals(stages["deep"])), 1),
+        rem_minutes=round(_minutes(merge_intervals(stages["rem"])), 1),
+        segment_count=sum(len(s) for s in segments_by_source.values()),
+    )
+
+
+def rebuild_sleep_sessions(nights=None):
+    """Recompute nightly sleep sessions from raw sleep segments.
+
+    Pass the set of nights touched by an ingest to update only those rows;
+    with no argument every night is rebuilt (used as a one-off backfill).
+    Returns the number of sessions written.
+    """
+    query = db.session.query(
+        Record.source_name, Record.value, Record.start_date, Record.end_date,
+        Record.utc_offset_minutes
+    ).filter(Record.type == SLEEP_TYPE, Record.end_date.isnot(None)).order_by(Record.start_date)
+
+    if nights is not None:
+        nights = set(nights)
+        if not nights:
+            return 0
+        # A night's segments start on its own day or the morning after
+        query = query.filter(
+            Record.local_date >= min(nights),
+            Record.local_date <= max(nights) + timedelta(days=1),
+        )
+
+    # Group segments per night and source in a single pass over the rows
+    grouped = {}
+    for source_name, value, start, end, utc_offset_minutes in query.yield_per(5000):
+        if end <= start:
+            continue
+        # Nights follow the device's local clock, the same clock local_date
+        # (used to select the rows above) is based on
+        night = night_of(start, utc_offset_minutes)
+        if nights is not None and night not in nights:
+            continue
+        grouped.setdefault(night, {}).setdefault(source_name, []).append((value, start, end))
+
+    stale = db.session.query(SleepSession)
+    if nights is not None:
+        stale = stale.filter(SleepSession.night.in_(nights))
+    stale.delete(synchronize_session=False)
+
+    written = 0
+    for night, segments_by_source in grouped.items():
+        session = build_session(night, segments_by_source)
+        if session is not None:
+            db.session.add(session)
+            written += 1
+
+    db.session.commit()
+    return written
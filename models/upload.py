@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+from models.db import db
+
+# An ingest commits (and so touches updated_at) every batch; one that hasn't
+# for this long belongs to a worker that died and may be claimed again
+INGEST_STALL_TIMEOUT = timedelta(minutes=10)
+
+# Unfinished sessions (and their temp files) untouched for this long are
+# deleted when the next session is created
+UPLOAD_SESSION_EXPIRY = timedelta(days=7)
+
+
+class UploadSession(db.Model):
+    __tablename__ = "upload_sessions"
+
+    id = db.Column(db.Text, primary_key=True)  # uuid4 hex, also the temp file name
+    filename = db.Column(db.Text)
+    total_size = db.Column(db.BigInteger, nullable=False)
+    received_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    # uploading -> ingesting -> complete (or failed, which can be resumed)
+    status = db.Column(db.Text, nullable=False, default="uploading")
+    # Position of the last <Record> element whose rows are committed; a
+    # restarted ingest skips everything up to and including it
+    checkpoint = db.Column(db.Integer, nullable=False, default=0)
+    records_ingested = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    @property
+    def stalled(self):
+        return (
+            self.status == "ingesting"
+            and self.updated_at is not None
+            and self.updated_at < datetime.utcnow() - INGEST_STALL_TIMEOUT
+        )
+
+    def to_dict(self):
+        return {
+            "upload_id": self.id,
+            "filename": self.filename,
+            "total_size": self.total_size,
+            "received_bytes": self.received_bytes,
+            "status": self.status,
+            "checkpoint": self.checkpoint,
+            "records_ingested": self.records_ingested,
+            "error": self.error,
+            "stalled": self.stalled,
+        }
@@ -3,6 +3,7 @@ from sqlalchemy import func, text, desc
 from datetime import datetime, timedelta
 from models.db import db
 from models.record import Record, RecordMetadata
+from models.sleep import SleepSession
 
 analytics_bp = Blueprint("analytics", __name__)
 
@@ -38,8 +39,11 @@ def get_health_stats():
             Record.type == 'HKQuantityTypeIdentifierActiveEnergyBurned'
         ).scalar()
         
-        # Get average sleep (in hours) - skip for now as sleep data is categorical
-        avg_sleep = None
+        # Get average sleep (in hours) from the precomputed nightly sessions
+        avg_sleep_minutes = db.session.query(func.avg(SleepSession.asleep_minutes)).filter(
+            SleepSession.asleep_minutes > 0
+        ).scalar()
+        avg_sleep = avg_sleep_minutes / 60 if avg_sleep_minutes else None
         
         return jsonify({
             "total_records": total_records or 0,
@@ -80,61 +84,57 @@ def get_timeline_data():
     """Get activity timeline data - using available data"""
     try:
         # Get the most recent 30 days of data (or all available data if less than 30 days)
-        # First, get the date range of available data
-        date_range = db.session.query(
-            func.min(Record.start_date),
-            func.max(Record.start_date)
-        ).first()
+        # First, get the latest day with data
+        latest_date = db.session.query(func.max(Record.local_date)).scalar()
         
-        if not date_range or not date_range[0] or not date_range[1]:
+        if not latest_date:
             return jsonify({
                 "daily_steps": [],
                 "daily_heart_rate": []
             })
         
         # Get the most recent 30 days from the latest date in the data
-        latest_date = date_range[1].date()
         thirty_days_ago = latest_date - timedelta(days=30)
         
         # Get daily step counts for the most recent 30 days of data
         daily_steps = db.session.query(
-            func.date(Record.start_date).label('date'),
+            Record.local_date.label('date'),
             func.sum(func.cast(Record.value, db.Numeric)).label('steps')
         ).filter(
             Record.type == 'HKQuantityTypeIdentifierStepCount',
-            func.date(Record.start_date) >= thirty_days_ago,
-            func.date(Record.start_date) <= latest_date
-        ).group_by(func.date(Record.start_date)).order_by('date').all()
+            Record.local_date >= thirty_days_ago,
+            Record.local_date <= latest_date
+        ).group_by(Record.local_date).order_by('date').all()
         
         # Get daily heart rate averages for the most recent 30 days of data
         daily_heart_rate = db.session.query(
-            func.date(Record.start_date).label('date'),
+            Record.local_date.label('date'),
             func.avg(func.cast(Record.value, db.Numeric)).label('heart_rate')
         ).filter(
             Record.type == 'HKQuantityTypeIdentifierHeartRate',
             Record.unit == 'count/min',
-            func.date(Record.start_date) >= thirty_days_ago,
-            func.date(Record.start_date) <= latest_date
-        ).group_by(func.date(Record.start_date)).order_by('date').all()
+            Record.local_date >= thirty_days_ago,
+            Record.local_date <= latest_date
+        ).group_by(Record.local_date).order_by('date').all()
         
         # If no recent data, get the most recent 30 days of any data
         if not daily_steps and not daily_heart_rate:
             # Get the most recent 30 days of step data
             daily_steps = db.session.query(
-                func.date(Record.start_date).label('date'),
+                Record.local_date.label('date'),
                 func.sum(func.cast(Record.value, db.Numeric)).label('steps')
             ).filter(
                 Record.type == 'HKQuantityTypeIdentifierStepCount'
-            ).group_by(func.date(Record.start_date)).order_by(desc('date')).limit(30).all()
+            ).group_by(Record.local_date).order_by(desc('date')).limit(30).all()
             
             # Get the most recent 30 days of heart rate data
             daily_heart_rate = db.session.query(
-                func.date(Record.start_date).label('date'),
+                Record.local_date.label('date'),
                 func.avg(func.cast(Record.value, db.Numeric)).label('heart_rate')
             ).filter(
                 Record.type == 'HKQuantityTypeIdentifierHeartRate',
                 Record.unit == 'count/min'
-            ).group_by(func.date(Record.start_date)).order_by(desc('date')).limit(30).all()
+            ).group_by(Record.local_date).order_by(desc('date')).limit(30).all()
         
         return jsonify({
             "daily_steps": [
@@ -154,30 +154,30 @@ def get_heart_rate_trends():
     """Get heart rate trends over time - using available data"""
     try:
         # Get heart rate data for the last 30 days (or available data)
-        thirty_days_ago = datetime.now() - timedelta(days=30)
+        thirty_days_ago = datetime.now().date() - timedelta(days=30)
         
         heart_rate_data = db.session.query(
-            func.date(Record.start_date).label('date'),
+            Record.local_date.label('date'),
             func.avg(func.cast(Record.value, db.Numeric)).label('avg_heart_rate'),
             func.min(func.cast(Record.value, db.Numeric)).label('min_heart_rate'),
             func.max(func.cast(Record.value, db.Numeric)).label('max_heart_rate')
         ).filter(
             Record.type == 'HKQuantityTypeIdentifierHeartRate',
             Record.unit == 'count/min',
-            Record.start_date >= thirty_days_ago
-        ).group_by(func.date(Record.start_date)).order_by('date').limit(30).all()
+            Record.local_date >= thirty_days_ago
+        ).group_by(Record.local_date).order_by('date').limit(30).all()
         
         # If no recent data, get the most recent 30 days of heart rate data
         if not heart_rate_data:
             heart_rate_data = db.session.query(
-                func.date(Record.start_date).label('date'),
+                Record.local_date.label('date'),
                 func.avg(func.cast(Record.value, db.Numeric)).label('avg_heart_rate'),
                 func.min(func.cast(Record.value, db.Numeric)).label('min_heart_rate'),
                 func.max(func.cast(Record.value, db.Numeric)).label('max_heart_rate')
             ).filter(
                 Record.type == 'HKQuantityTypeIdentifierHeartRate',
                 Record.unit == 'count/min'
-            ).group_by(func.date(Record.start_date)).order_by(desc('date')).limit(30).all()
+            ).group_by(Record.local_date).order_by(desc('date')).limit(30).all()
         
         return jsonify({
             "heart_rate_trends": [
@@ -296,7 +296,7 @@ def get_daily_summary():
     """Get daily activity summary - using most recent data"""
     try:
         # Get the most recent date with data
-        most_recent_date = db.session.query(func.max(func.date(Record.start_date))).scalar()
+        most_recent_date = db.session.query(func.max(Record.local_date)).scalar()
         
         if not most_recent_date:
             return jsonify({
@@ -312,26 +312,26 @@ def get_daily_summary():
         # Get steps for the most recent date
         recent_steps = db.session.query(func.sum(func.cast(Record.value, db.Numeric))).filter(
             Record.type == 'HKQuantityTypeIdentifierStepCount',
-            func.date(Record.start_date) == most_recent_date
+            Record.local_date == most_recent_date
         ).scalar()
         
         # Get calories for the most recent date
         recent_calories = db.session.query(func.sum(func.cast(Record.value, db.Numeric))).filter(
             Record.type == 'HKQuantityTypeIdentifierActiveEnergyBurned',
-            func.date(Record.start_date) == most_recent_date
+            Record.local_date == most_recent_date
         ).scalar()
         
         # Get average heart rate for the most recent date
         recent_heart_rate = db.session.query(func.avg(func.cast(Record.value, db.Numeric))).filter(
             Record.type == 'HKQuantityTypeIdentifierHeartRate',
             Record.unit == 'count/min',
-            func.date(Record.start_date) == most_recent_date
+            Record.local_date == most_recent_date
         ).scalar()
         
         # Get distance for the most recent date
         recent_distance = db.session.query(func.sum(func.cast(Record.value, db.Numeric))).filter(
             Record.type == 'HKQuantityTypeIdentifierDistanceWalkingRunning',
-            func.date(Record.start_date) == most_recent_date
+            Record.local_date == most_recent_date
         ).scalar()
         
         return jsonify({
@@ -351,39 +351,46 @@ def get_health_insights():
     """Get health insights and workout recommendations"""
     try:
         # Get recent activity data (last 7 days)
-        seven_days_ago = datetime.now() - timedelta(days=7)
+        seven_days_ago = datetime.now().date() - timedelta(days=7)
         
         # Get average daily steps for the last 7 days
         recent_steps = db.session.query(func.avg(func.cast(Record.value, db.Numeric))).filter(
             Record.type == 'HKQuantityTypeIdentifierStepCount',
-            Record.start_date >= seven_days_ago
+            Record.local_date >= seven_days_ago
         ).scalar()
         
         # Get average daily calories for the last 7 days
         recent_calories = db.session.query(func.avg(func.cast(Record.value, db.Numeric))).filter(
             Record.type == 'HKQuantityTypeIdentifierActiveEnergyBurned',
-            Record.start_date >= seven_days_ago
+            Record.local_date >= seven_days_ago
         ).scalar()
         
         # Get average heart rate for the last 7 days
         recent_heart_rate = db.session.query(func.avg(func.cast(Record.value, db.Numeric))).filter(
             Record.type == 'HKQuantityTypeIdentifierHeartRate',
             Record.unit == 'count/min',
-            Record.start_date >= seven_days_ago
+            Record.local_date >= seven_days_ago
         ).scalar()
         
         # Get yesterday's activity
         yesterday = datetime.now().date() - timedelta(days=1)
         yesterday_steps = db.session.query(func.sum(func.cast(Record.value, db.Numeric))).filter(
             Record.type == 'HKQuantityTypeIdentifierStepCount',
-            func.date(Record.start_date) == yesterday
+            Record.local_date == yesterday
         ).scalar()
         
         yesterday_calories = db.session.query(func.sum(func.cast(Record.value, db.Numeric))).filter(
             Record.type == 'HKQuantityTypeIdentifierActiveEnergyBurned',
-            func.date(Record.start_date) == yesterday
+            Record.local_date == yesterday
         ).scalar()
         
+        # Get average nightly sleep (in hours) for the last 7 nights
+        recent_sleep_minutes = db.session.query(func.avg(SleepSession.asleep_minutes)).filter(
+            SleepSession.night >= seven_days_ago,
+            SleepSession.asleep_minutes > 0
+        ).scalar()
+        recent_sleep = recent_sleep_minutes / 60 if recent_sleep_minutes else None
+        
         # Calculate workout recommendation
         recommendation = calculate_workout_recommendation(
             recent_steps or 0,
@@ -397,7 +404,8 @@ def get_health_insights():
         recovery_score = calculate_recovery_score(
             recent_steps or 0,
             recent_calories or 0,
-            recent_heart_rate or 0
+            recent_heart_rate or 0,
+            recent_sleep
         )
         
         return jsonify({
@@ -405,7 +413,8 @@ def get_health_insights():
                 "recent_activity": {
                     "avg_daily_steps": int(recent_steps) if recent_steps else 0,
                     "avg_daily_calories": int(recent_calories) if recent_calories else 0,
-                    "avg_heart_rate": round(recent_heart_rate, 1) if recent_heart_rate else 0
+                    "avg_heart_rate": round(recent_heart_rate, 1) if recent_heart_rate else 0,
+                    "avg_sleep_hours": round(recent_sleep, 1) if recent_sleep else 0
                 },
                 "yesterday_activity": {
                     "steps": int(yesterday_steps) if yesterday_steps else 0,
@@ -498,7 +507,7 @@ def calculate_workout_recommendation(avg_steps, avg_calories, avg_hr, yesterday_
             ]
         }
 
-def calculate_recovery_score(avg_steps, avg_calories, avg_hr):
+def calculate_recovery_score(avg_steps, avg_calories, avg_hr, avg_sleep_hours=None):
     """Calculate a recovery score from 0-100"""
     
     # Normalize metrics (these are rough estimates)
@@ -515,8 +524,14 @@ def calculate_recovery_score(avg_steps, avg_calories, avg_hr):
     else:
         hr_score = 40
     
+    # Sleep score (8 hours = 100%), only weighted in when sleep data exists
+    sleep_score = min(100, (avg_sleep_hours / 8) * 100) if avg_sleep_hours else None
+    
     # Weighted average
-    recovery_score = (steps_score * 0.4 + calories_score * 0.4 + hr_score * 0.2)
+    if sleep_score is None:
+        recovery_score = (steps_score * 0.4 + calories_score * 0.4 + hr_score * 0.2)
+    else:
+        recovery_score = (steps_score * 0.3 + calories_score * 0.3 + hr_score * 0.2 + sleep_score * 0.2)
     
     return {
         "score": round(recovery_score, 1),
@@ -524,6 +539,7 @@ def calculate_recovery_score(avg_steps, avg_calories, avg_hr):
         "breakdown": {
             "activity_score": round(steps_score, 1),
             "calorie_score": round(calories_score, 1),
-            "heart_rate_score": round(hr_score, 1)
+            "heart_rate_score": round(hr_score, 1),
+            "sleep_score": round(sleep_score, 1) if sleep_score is not None else None
         }
     }
@@ -1,12 +1,234 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, current_app, request, jsonify
 import os
+import tempfile
+import threading
+import uuid
 from lxml import etree
-from datetime import datetime
-from models.db import db
+from datetime import date, datetime, timezone
+from sqlalchemy import and_, delete, insert, or_, text, update
+from models.db import db, DATABASE_BACKEND
 from models.record import Record, RecordMetadata
+from models.sleep import SLEEP_TYPE, night_of, rebuild_sleep_sessions
+from models.upload import INGEST_STALL_TIMEOUT, UPLOAD_SESSION_EXPIRY, UploadSession
 
 upload_bp = Blueprint("upload", __name__)
 
+TEMP_DIR = "temp"
+
+# Background ingests running in this process, by upload id, and the flag
+# that stops them when the worker exits (see stop_ingests)
+_ingest_threads = {}
+_shutdown = threading.Event()
+
+
+def ingest_xml(path, upload_session=None):
+    """Stream Record elements from an Apple Health export into the database.
+
+    When an UploadSession is given, its checkpoint is committed together with
+    every batch, and elements at or before an existing checkpoint are skipped
+    so a restarted ingest continues without duplicating committed rows.
+    Returns the number of records ingested by this run.
+    """
+    count = 0
+    position = 0  # Index of the current <Record> element in the file
+    resume_from = upload_session.checkpoint if upload_session else 0
+    batch_size = 1000  # Process in batches to manage memory
+    sleep_nights = set()  # Nights whose sleep sessions need rebuilding
+    pending_records = []  # Record rows for the current batch
+    pending_metadata = []  # [(key, value), ...] per pending record
+
+    if resume_from:
+        print(f"Resuming ingest after record {resume_from}")
+
+    # Use streaming XML parser to avoid loading entire file into memory
+    context = etree.iterparse(path, events=('end',), tag='Record')
+
+    for event, record in context:
+        position += 1
+        try:
+            record_type = record.get("type")
+            start_date = record.get("startDate")
+            end_date = record.get("endDate")
+            value = record.get("value")
+            unit = record.get("unit")
+            source_name = record.get("sourceName")
+            source_version = record.get("sourceVersion")
+            device = record.get("device")
+            creation_date = record.get("creationDate")
+
+            # Parse dates
+            try:
+                start_dt = datetime.strptime(start_date, "%Y-%m-%d %H:%M:%S %z")
+                end_dt = (
+                    datetime.strptime(end_date, "%Y-%m-%d %H:%M:%S %z")
+                    if end_date
+                    else None
+                )
+                creation_dt = (
+                    datetime.strptime(creation_date, "%Y-%m-%d %H:%M:%S %z")
+                    if creation_date
+                    else None
+                )
+            except Exception:
+                continue
+
+            if record_type == SLEEP_TYPE:
+                sleep_nights.add(night_of(start_dt))
+
+            # Already committed by an earlier run of this upload
+            if position <= resume_from:
+                record.clear()
+                continue
+
+            # Queue the record; rows are inserted a batch at a time
+            pending_records.append({
+                "type": record_type,
+                "start_date": start_dt,
+                "end_date": end_dt,
+                "local_date": start_dt.date(),
+                "utc_offset_minutes": int(start_dt.utcoffset().total_seconds() // 60),
+                "value": value,
+                "unit": unit,
+                "source_name": source_name,
+                "source_version": source_version,
+                "device": device,
+                "creation_date": creation_dt,
+            })
+
+            # Process metadata
+            pending_metadata.append([
+                (meta.get("key"), meta.get("value"))
+                for meta in record.findall("MetadataEntry")
+                if meta.get("key") and meta.get("value")
+            ])
+
+            count += 1
+
+            # Clear the element to free memory
+            record.clear()
+
+        except Exception as e:
+            print(f"Error processing record: {e}")
+            continue
+
+        # Commit in batches to manage memory, checkpointing in the same transaction.
+        # A failed batch aborts the ingest; the previous checkpoint still holds
+        if count % batch_size == 0:
+            if _shutdown.is_set():
+                raise RuntimeError("Worker exited during ingest")
+            _insert_batch(pending_records, pending_metadata)
+            pending_records, pending_metadata = [], []
+            if upload_session:
+                upload_session.checkpoint = position
+                upload_session.records_ingested += batch_size
+            db.session.commit()
+            print(f"Processed {count} records...")
+
+    # Final commit for remaining records
+    _insert_batch(pending_records, pending_metadata)
+    if upload_session:
+        upload_session.checkpoint = position
+        upload_session.records_ingested += count % batch_size
+    db.session.commit()
+    print(f"Final commit successful. Total records processed: {count}")
+
+    # Refresh the precomputed nightly sleep sessions touched by this upload.
+    # A failure fails the ingest: nothing else would rebuild these nights, and
+    # a resumed ingest collects them again from the whole file
+    sessions = rebuild_sleep_sessions(sleep_nights)
+    print(f"Rebuilt {sessions} sleep sessions")
+
+    return count
+
+
+def _insert_batch(records, metadata):
+    """Insert a batch of record rows and their metadata with one executemany each.
+
+    Ids are taken from the records sequence up front so metadata rows can
+    reference them without a flush (and round trip) per record.
+    """
+    if not records:
+        return
+    metadata_rows = []
+    for record_id, row, entries in zip(_next_ids("records_id_seq", len(records)), records, metadata):
+        row["id"] = record_id
+        metadata_rows.extend(
+            {"record_id": record_id, "key": key, "value": val} for key, val in entries
+        )
+    for metadata_id, row in zip(_next_ids("record_metadata_id_seq", len(metadata_rows)), metadata_rows):
+        row["id"] = metadata_id
+
+    if DATABASE_BACKEND == "duckdb":
+        _copy_rows(Record.__table__, records)
+        _copy_rows(RecordMetadata.__table__, metadata_rows)
+    else:
+        db.session.execute(insert(Record), records)
+        if metadata_rows:
+            db.session.execute(insert(RecordMetadata), metadata_rows)
+
+
+def _next_ids(sequence_name, n):
+    """Reserve n ids from a sequence in one round trip"""
+    if not n:
+        return []
+    return db.session.execute(
+        text(f"SELECT nextval('{sequence_name}') FROM generate_series(1, :n)"),
+        {"n": n},
+    ).scalars().all()
+
+
+def _copy_rows(table, rows):
+    """Bulk load rows into a DuckDB table through a staged CSV file.
+
+    DuckDB's Python binding converts bound parameters one value at a time, so
+    executemany runs at a few hundred rows/s; read_csv loads a batch in one
+    vectorized scan, inside the current transaction.
+    """
+    if not rows:
+        return
+    columns = [column for column in table.columns if column.name in rows[0]]
+
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".csv", dir=TEMP_DIR)
+    try:
+        # read_csv expects UTF-8 regardless of the locale; device names often
+        # carry non-ASCII characters such as the ’ in "Sam’s Apple Watch"
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            for row in rows:
+                f.write(",".join(_csv_field(row.get(column.name)) for column in columns))
+                f.write("\n")
+
+        column_types = ", ".join(
+            f"'{column.name}': '{column.type.compile(dialect=db.engine.dialect)}'"
+            for column in columns
+        )
+        column_names = ", ".join(f'"{column.name}"' for column in columns)
+        csv_path = path.replace("'", "''")
+        db.session.execute(text(
+            f"INSERT INTO {table.name} ({column_names}) "
+            f"SELECT * FROM read_csv('{csv_path}', header = false, auto_detect = false, "
+            f"allow_quoted_nulls = false, columns = {{{column_types}}})"
+        ))
+    finally:
+        os.remove(path)
+
+
+def _csv_field(value):
+    # Non-numeric values are always quoted, so '' stays an empty string and
+    # only an unquoted empty field loads as NULL
+    if value is None:
+        return ""
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, datetime):
+        # Stored as naive UTC, matching how aware datetimes are bound
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        value = value.isoformat(sep=" ")
+    elif isinstance(value, date):
+        value = value.isoformat()
+    return '"' + str(value).replace('"', '""') + '"'
+
 
 @upload_bp.route("/upload", methods=["POST"])
 def upload_xml():
@@ -16,104 +238,255 @@ def upload_xml():
     if file.filename == "":
         return jsonify({"error": "No selected file"}), 400
 
-    temp_path = os.path.join("temp", file.filename)
-    os.makedirs("temp", exist_ok=True)
+    temp_path = os.path.join(TEMP_DIR, file.filename)
+    os.makedirs(TEMP_DIR, exist_ok=True)
     file.save(temp_path)
 
     try:
-        count = 0
-        batch_size = 1000  # Process in batches to manage memory
-        
-        # Use streaming XML parser to avoid loading entire file into memory
-        context = etree.iterparse(temp_path, events=('end',), tag='Record')
-        
-        for event, record in context:
-            try:
-                record_type = record.get("type")
-                start_date = record.get("startDate")
-                end_date = record.get("endDate")
-                value = record.get("value")
-                unit = record.get("unit")
-                source_name = record.get("sourceName")
-                source_version = record.get("sourceVersion")
-                device = record.get("device")
-                creation_date = record.get("creationDate")
-
-                # Parse dates
-                try:
-                    start_dt = datetime.strptime(start_date, "%Y-%m-%d %H:%M:%S %z")
-                    end_dt = (
-                        datetime.strptime(end_date, "%Y-%m-%d %H:%M:%S %z")
-                        if end_date
-                        else None
-                    )
-                    creation_dt = (
-                        datetime.strptime(creation_date, "%Y-%m-%d %H:%M:%S %z")
-                        if creation_date
-                        else None
-                    )
-                except Exception:
-                    continue
-
-                # Create record
-                db_record = Record(
-                    type=record_type,
-                    start_date=start_dt,
-                    end_date=end_dt,
-                    value=value,
-                    unit=unit,
-                    source_name=source_name,
-                    source_version=source_version,
-                    device=device,
-                    creation_date=creation_dt,
-                )
-                db.session.add(db_record)
-                db.session.flush()
-
-                # Process metadata
-                for meta in record.findall("MetadataEntry"):
-                    key = meta.get("key")
-                    val = meta.get("value")
-                    if key and val:
-                        db.session.add(
-                            RecordMetadata(record_id=db_record.id, key=key, value=val)
-                        )
-                
-                count += 1
-                
-                # Commit in batches to manage memory
-                if count % batch_size == 0:
-                    db.session.commit()
-                    print(f"Processed {count} records...")
-                
-                # Clear the element to free memory
-                record.clear()
-                
-            except Exception as e:
-                print(f"Error processing record: {e}")
-                continue
-        
-        # Final commit for remaining records
-        try:
-            db.session.commit()
-            print(f"Final commit successful. Total records processed: {count}")
-        except Exception as commit_error:
-            print(f"Final commit failed: {commit_error}")
-            db.session.rollback()
-            # Clean up
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            return jsonify({"error": f"Database commit failed: {str(commit_error)}"}), 500
-        
-        # Clean up
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-        
+        count = ingest_xml(temp_path)
         return jsonify({"message": f"Successfully ingested {count} records."}), 200
 
     except Exception as e:
         print(f"Upload error: {e}")
-        # Clean up on error
+        db.session.rollback()
+        return jsonify({"error": f"Upload failed: {str(e)}"}), 500
+    finally:
+        # Clean up
         if os.path.exists(temp_path):
             os.remove(temp_path)
-        return jsonify({"error": f"Upload failed: {str(e)}"}), 500
+
+
+def _session_path(upload_id):
+    return os.path.join(TEMP_DIR, f"{upload_id}.xml")
+
+
+def _get_upload_session(upload_id):
+    # Ids are uuid4 hex strings; anything else can't name a temp file safely
+    try:
+        upload_id = uuid.UUID(upload_id).hex
+    except ValueError:
+        return None
+    return db.session.get(UploadSession, upload_id)
+
+
+@upload_bp.route("/upload/sessions", methods=["POST"])
+def create_upload_session():
+    """Start a resumable upload; chunks are then sent to /upload/sessions/<id>/chunk"""
+    data = request.get_json(silent=True) or {}
+    total_size = data.get("total_size")
+    if not isinstance(total_size, int) or total_size <= 0:
+        return jsonify({"error": "total_size must be a positive integer"}), 400
+    if total_size > current_app.config["MAX_CONTENT_LENGTH"]:
+        return jsonify({"error": "File size exceeds upload limit"}), 413
+
+    _expire_upload_sessions()
+
+    upload_session = UploadSession(
+        id=uuid.uuid4().hex,
+        filename=data.get("filename"),
+        total_size=total_size,
+    )
+    db.session.add(upload_session)
+    db.session.commit()
+
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    open(_session_path(upload_session.id), "wb").close()
+
+    return jsonify(upload_session.to_dict()), 201
+
+
+def _expire_upload_sessions():
+    """Delete abandoned or failed sessions and their temp files so they can't fill the disk"""
+    cutoff = datetime.utcnow() - UPLOAD_SESSION_EXPIRY
+    try:
+        expired = db.session.execute(
+            delete(UploadSession)
+            .where(UploadSession.status != "complete", UploadSession.updated_at < cutoff)
+            .returning(UploadSession.id)
+            .execution_options(synchronize_session=False)
+        ).scalars().all()
+        db.session.commit()
+    except Exception as e:
+        print(f"Could not expire upload sessions: {e}")
+        db.session.rollback()
+        return
+    if not expired:
+        return
+
+    for upload_id in expired:
+        path = _session_path(upload_id)
+        if os.path.exists(path):
+            os.remove(path)
+    print(f"Expired {len(expired)} upload sessions")
+
+
+@upload_bp.route("/upload/sessions/<upload_id>", methods=["GET"])
+def get_upload_session(upload_id):
+    """Report how far an upload got so the client knows where to resume"""
+    upload_session = _get_upload_session(upload_id)
+    if upload_session is None:
+        return jsonify({"error": "Upload session not found"}), 404
+    return jsonify(upload_session.to_dict())
+
+
+@upload_bp.route("/upload/sessions/<upload_id>/chunk", methods=["PUT"])
+def upload_chunk(upload_id):
+    """Append a chunk of raw bytes; the offset query arg must equal received_bytes"""
+    upload_session = _get_upload_session(upload_id)
+    if upload_session is None:
+        return jsonify({"error": "Upload session not found"}), 404
+    if upload_session.status != "uploading":
+        return jsonify({"error": f"Upload is already {upload_session.status}", **upload_session.to_dict()}), 409
+
+    offset = request.args.get("offset", type=int)
+    path = _session_path(upload_session.id)
+    # The file on disk is the source of truth if a worker died mid-write
+    received = os.path.getsize(path) if os.path.exists(path) else 0
+    if offset != received:
+        upload_session.received_bytes = received
+        db.session.commit()
+        return jsonify({"error": "Offset mismatch", **upload_session.to_dict()}), 409
+
+    chunk = request.get_data()
+    if received + len(chunk) > upload_session.total_size:
+        return jsonify({"error": "Chunk exceeds declared total_size"}), 400
+
+    # Write at the requested offset rather than appending: a retry racing the
+    # original request passes the same offset check, and positional writes of
+    # the same bytes leave one copy instead of two. The file never shrinks, so
+    # a late duplicate can't cut off chunks written after it
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+    try:
+        written = 0
+        while written < len(chunk):
+            written += os.pwrite(fd, chunk[written:], offset + written)
+    finally:
+        os.close(fd)
+
+    upload_session.received_bytes = os.path.getsize(path)
+    db.session.commit()
+    return jsonify(upload_session.to_dict())
+
+
+def _claim_ingest(upload_session):
+    """Atomically move a fully received session to "ingesting".
+
+    Only one caller can win the conditional UPDATE, so concurrent or retried
+    complete requests never run two ingests of the same file. A session left
+    "ingesting" by a killed worker can be claimed again once it has stalled.
+    """
+    now = datetime.utcnow()
+    try:
+        claimed = db.session.execute(
+            update(UploadSession)
+            .where(
+                UploadSession.id == upload_session.id,
+                UploadSession.received_bytes == UploadSession.total_size,
+                or_(
+                    UploadSession.status.in_(["uploading", "failed"]),
+                    and_(
+                        UploadSession.status == "ingesting",
+                        UploadSession.updated_at < now - INGEST_STALL_TIMEOUT,
+                    ),
+                ),
+            )
+            .values(status="ingesting", error=None, updated_at=now)
+            .returning(UploadSession.id)
+            .execution_options(synchronize_session=False)
+        ).scalar()
+        db.session.commit()
+    except Exception as e:
+        # e.g. a DuckDB write-write conflict with a concurrent claim
+        print(f"Could not claim ingest: {e}")
+        db.session.rollback()
+        claimed = None
+    db.session.refresh(upload_session)
+    return claimed is not None
+
+
+def _run_ingest(app, upload_id):
+    """Ingest a claimed upload session outside the request that started it"""
+    with app.app_context():
+        upload_session = db.session.get(UploadSession, upload_id)
+        path = _session_path(upload_session.id)
+        try:
+            ingest_xml(path, upload_session)
+        except Exception as e:
+            print(f"Upload error: {e}")
+            db.session.rollback()
+            # Committed batches and their checkpoint survive; calling complete
+            # again resumes from there
+            upload_session.status = "failed"
+            upload_session.error = str(e)
+            db.session.commit()
+            return
+        finally:
+            _ingest_threads.pop(upload_id, None)
+
+        upload_session.status = "complete"
+        db.session.commit()
+
+        # Clean up
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def stop_ingests(timeout=10):
+    """Stop this process's background ingests and mark them failed.
+
+    Called from gunicorn's worker_exit hook, so a client polling an upload
+    resumes it from its checkpoint right away instead of waiting for the
+    session to stall. Each ingest stops at its next batch boundary; one that
+    doesn't within timeout is marked failed here and dies with the worker.
+    """
+    _shutdown.set()
+    for thread in list(_ingest_threads.values()):
+        thread.join(timeout)
+
+    upload_ids = list(_ingest_threads)
+    if not upload_ids:
+        return
+    db.session.execute(
+        update(UploadSession)
+        .where(UploadSession.id.in_(upload_ids), UploadSession.status == "ingesting")
+        .values(status="failed", error="Worker exited during ingest")
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+@upload_bp.route("/upload/sessions/<upload_id>/complete", methods=["POST"])
+def complete_upload_session(upload_id):
+    """Start ingesting an assembled upload, resuming from its checkpoint if it was interrupted.
+
+    The ingest runs in a background thread so it isn't bound by the worker
+    timeout; poll GET /upload/sessions/<id> until status is complete or failed.
+    """
+    upload_session = _get_upload_session(upload_id)
+    if upload_session is None:
+        return jsonify({"error": "Upload session not found"}), 404
+    if upload_session.status == "complete":
+        return jsonify(upload_session.to_dict()), 200
+    if upload_session.status != "ingesting" or upload_session.stalled:
+        # The temp file, not received_bytes, is what gets ingested; if it was
+        # lost or cut short, go back to uploading from what is actually there
+        path = _session_path(upload_session.id)
+        received = os.path.getsize(path) if os.path.exists(path) else 0
+        if received < upload_session.total_size:
+            upload_session.received_bytes = received
+            upload_session.status = "uploading"
+            db.session.commit()
+    if upload_session.received_bytes != upload_session.total_size:
+        return jsonify({"error": "Upload is incomplete", **upload_session.to_dict()}), 409
+    if not _claim_ingest(upload_session):
+        return jsonify({"error": f"Upload is already {upload_session.status}", **upload_session.to_dict()}), 409
+
+    thread = threading.Thread(
+        target=_run_ingest,
+        args=(current_app._get_current_object(), upload_session.id),
+        daemon=True,
+    )
+    _ingest_threads[upload_session.id] = thread
+    thread.start()
+
+    return jsonify(upload_session.to_dict()), 202
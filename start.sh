@@ -1,5 +1,29 @@
 #!/bin/sh
 # Entrypoint script for starting the Flask app with Gunicorn/UvicornWorker
-WORKERS=${WORKERS:-$(expr $(nproc) \* 2 + 1)}
+# An embedded DuckDB file can only be opened read-write by one process, so
+# that backend runs a single worker and scales with threads instead
+if [ "$DATABASE_BACKEND" = "duckdb" ]; then
+    WORKERS=${WORKERS:-1}
+    THREADS=${THREADS:-$(expr $(nproc) \* 2 + 1)}
+else
+    WORKERS=${WORKERS:-$(expr $(nproc) \* 2 + 1)}
+    THREADS=${THREADS:-1}
+fi
 
-exec gunicorn backend_server:app --workers $WORKERS --bind 0.0.0.0:8000 --timeout 300 --keep-alive 2 --max-requests 1000 --max-requests-jitter 100
+# Create/upgrade the schema once here instead of in every worker
+flask --app backend_server init-db || exit 1
+
+# Optionally run the analytics queries once so the first dashboard load is warm.
+# This warms the Postgres server's cache; DuckDB's buffer pool lives in the
+# process that opens the file, so warming it here would be thrown away
+if [ "${WARMUP:-0}" = "1" ]; then
+    if [ "$DATABASE_BACKEND" = "duckdb" ]; then
+        echo "Skipping warm-up: not supported with the embedded DuckDB backend"
+    else
+        flask --app backend_server warm-up
+    fi
+fi
+
+# --preload imports the app (lxml, models, engine setup) once in the master,
+# so forked and recycled workers start without repeating that work
+exec gunicorn backend_server:app --config gunicorn.conf.py --preload --workers $WORKERS --threads $THREADS --bind 0.0.0.0:8000 --timeout 300 --keep-alive 2 --max-requests 1000 --max-requests-jitter 100
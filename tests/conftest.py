@@ -0,0 +1,45 @@
+import os
+import tempfile
+from xml.sax.saxutils import quoteattr
+
+import pytest
+
+pytest.importorskip("duckdb_engine")
+
+# Run against an embedded DuckDB file; set before the app and models import
+os.environ["DATABASE_BACKEND"] = "duckdb"
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "test.duckdb")
+
+from backend_server import app as flask_app  # noqa: E402
+from models.db import db  # noqa: E402
+from models.schema import init_schema  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # Uploads are staged under a relative temp/ directory
+    monkeypatch.chdir(tmp_path)
+    with flask_app.app_context():
+        db.drop_all()
+        init_schema()
+        yield flask_app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def write_export(tmp_path):
+    """Write a minimal Apple Health export from a list of Record attribute dicts"""
+    def write(records):
+        path = tmp_path / "export.xml"
+        with open(path, "w", encoding="utf-8") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<HealthData locale="en_US">\n')
+            for attrs in records:
+                f.write("<Record " + " ".join(f"{k}={quoteattr(str(v))}" for k, v in attrs.items()) + "/>\n")
+            f.write("</HealthData>\n")
+        return str(path)
+    return write
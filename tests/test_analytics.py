@@ -0,0 +1,34 @@
+from datetime import date
+
+from models.record import Record
+from routes.upload import ingest_xml
+
+
+def step_record(value, start):
+    return {
+        "type": "HKQuantityTypeIdentifierStepCount", "sourceName": "Watch", "unit": "count",
+        "value": value, "startDate": start, "endDate": start,
+    }
+
+
+def test_timeline_groups_records_by_device_local_day(client, write_export):
+    ingest_xml(write_export([
+        # 23:30 local west of UTC is already the next day in UTC
+        step_record(100, "2024-03-01 23:30:00 -0700"),
+        # 00:30 local east of UTC is still the previous day in UTC
+        step_record(20, "2024-03-02 00:30:00 +0530"),
+        step_record(3, "2024-03-02 23:30:00 +0530"),
+    ]))
+
+    assert [(r.local_date, r.utc_offset_minutes) for r in Record.query.order_by(Record.start_date)] == [
+        (date(2024, 3, 2), 330),
+        (date(2024, 3, 1), -420),
+        (date(2024, 3, 2), 330),
+    ]
+
+    response = client.get("/analytics/timeline")
+    assert response.status_code == 200
+    assert response.get_json()["daily_steps"] == [
+        {"date": "2024-03-01", "steps": 100},
+        {"date": "2024-03-02", "steps": 23},
+    ]
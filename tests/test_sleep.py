@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta, timezone
+
+from models.sleep import SLEEP_TYPE, SleepSession, build_session, merge_intervals, night_of
+from routes.upload import ingest_xml
+
+CORE = "HKCategoryValueSleepAnalysisAsleepCore"
+REM = "HKCategoryValueSleepAnalysisAsleepREM"
+ASLEEP = "HKCategoryValueSleepAnalysisAsleepUnspecified"
+IN_BED = "HKCategoryValueSleepAnalysisInBed"
+
+
+def at(hour, minute=0, day=1):
+    return datetime(2024, 3, day, hour, minute)
+
+
+def test_merge_intervals_joins_overlapping_and_touching():
+    merged = merge_intervals([
+        (at(23), at(23, 30)),
+        (at(22), at(23, 10)),  # overlaps the first
+        (at(23, 30), at(23, 45)),  # touches it
+        (at(23, 50), at(23, 55)),  # separate
+    ])
+    assert merged == [[at(22), at(23, 45)], [at(23, 50), at(23, 55)]]
+
+
+def test_merge_intervals_keeps_contained_interval_end():
+    assert merge_intervals([(at(1), at(5)), (at(2), at(3))]) == [[at(1), at(5)]]
+
+
+def test_build_session_prefers_staged_source():
+    session = build_session(at(0).date(), {
+        # A phone app reporting more (unstaged) sleep than the watch
+        "Phone": [(ASLEEP, at(22, day=1), at(7, day=2))],
+        "Watch": [
+            (CORE, at(23, day=1), at(2, day=2)),
+            (REM, at(2, day=2), at(3, day=2)),
+        ],
+    })
+    assert session.source_name == "Watch"
+    assert session.asleep_minutes == 240
+    assert session.core_minutes == 180
+    assert session.rem_minutes == 60
+    # In-bed time is the union of every source
+    assert session.in_bed_minutes == 540
+
+
+def test_build_session_falls_back_to_most_asleep_unstaged_source():
+    session = build_session(at(0).date(), {
+        "App A": [(ASLEEP, at(23, day=1), at(5, day=2))],
+        "App B": [(ASLEEP, at(23, day=1), at(1, day=2)), (IN_BED, at(22, day=1), at(7, day=2))],
+    })
+    assert session.source_name == "App A"
+    assert session.asleep_minutes == 360
+
+
+def test_night_of_noon_boundary():
+    assert night_of(at(11, 59, day=2)) == at(0).date()
+    assert night_of(at(12, 0, day=2)) == at(0, day=2).date()
+
+
+def test_night_of_uses_local_time():
+    local = timezone(timedelta(hours=-7))
+    # 04:30 local is 11:30 UTC, still the morning after night 2024-03-01
+    assert night_of(datetime(2024, 3, 2, 4, 30, tzinfo=local)) == at(0).date()
+    assert night_of(datetime(2024, 3, 2, 11, 30), -420) == at(0).date()
+    # 12:30 UTC is 05:30 local, still that night, but read without its
+    # offset it would land on the next night
+    assert night_of(datetime(2024, 3, 2, 12, 30), -420) == at(0).date()
+    assert night_of(datetime(2024, 3, 2, 12, 30)) == at(0, day=2).date()
+
+
+def test_ingest_builds_one_session_per_local_night(app, write_export):
+    def segment(value, start, end):
+        return {
+            "type": SLEEP_TYPE, "sourceName": "Watch", "value": value,
+            "startDate": f"2024-03-0{start} -0700", "endDate": f"2024-03-0{end} -0700",
+        }
+
+    path = write_export([
+        segment(CORE, "1 23:00:00", "2 04:30:00"),
+        segment(REM, "2 05:30:00", "2 06:30:00"),
+    ])
+    ingest_xml(path)
+
+    sessions = SleepSession.query.all()
+    assert [s.night for s in sessions] == [at(0).date()]
+    assert sessions[0].asleep_minutes == 390
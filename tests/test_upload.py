@@ -0,0 +1,196 @@
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func
+
+import routes.upload
+from models.db import db
+from models.record import Record
+from models.sleep import SLEEP_TYPE, SleepSession
+from models.upload import UPLOAD_SESSION_EXPIRY, UploadSession
+from routes.upload import _run_ingest, ingest_xml
+
+
+def heart_rate_records(n):
+    return [
+        {
+            "type": "HKQuantityTypeIdentifierHeartRate",
+            "sourceName": "Watch",
+            "unit": "count/min",
+            "value": 60 + i % 40,
+            "startDate": f"2024-03-01 {i // 3600:02d}:{i // 60 % 60:02d}:{i % 60:02d} -0700",
+            "endDate": f"2024-03-01 {i // 3600:02d}:{i // 60 % 60:02d}:{i % 60:02d} -0700",
+        }
+        for i in range(n)
+    ]
+
+
+def test_resumed_ingest_does_not_duplicate_rows(app, write_export, monkeypatch):
+    path = write_export(heart_rate_records(2500))
+    upload_session = UploadSession(id="a" * 32, total_size=1, received_bytes=1, status="ingesting")
+    db.session.add(upload_session)
+    db.session.commit()
+
+    # Fail the second batch, after the first one and its checkpoint are committed
+    insert_batch = routes.upload._insert_batch
+    calls = []
+
+    def failing_insert_batch(records, metadata):
+        calls.append(len(records))
+        if len(calls) == 2:
+            raise RuntimeError("worker killed")
+        insert_batch(records, metadata)
+
+    monkeypatch.setattr(routes.upload, "_insert_batch", failing_insert_batch)
+    with pytest.raises(RuntimeError):
+        ingest_xml(path, upload_session)
+    db.session.rollback()
+
+    assert upload_session.checkpoint == 1000
+    assert Record.query.count() == 1000
+
+    monkeypatch.setattr(routes.upload, "_insert_batch", insert_batch)
+    assert ingest_xml(path, upload_session) == 1500
+
+    assert upload_session.checkpoint == 2500
+    assert upload_session.records_ingested == 2500
+    assert Record.query.count() == 2500
+    assert db.session.query(func.count(func.distinct(Record.start_date))).scalar() == 2500
+
+
+def test_chunked_upload_ignores_duplicate_chunk(client, write_export):
+    data = open(write_export(heart_rate_records(10)), "rb").read()
+    upload_id = client.post(
+        "/upload/sessions", json={"filename": "export.xml", "total_size": len(data)}
+    ).get_json()["upload_id"]
+
+    half = len(data) // 2
+    assert client.put(f"/upload/sessions/{upload_id}/chunk?offset=0", data=data[:half]).status_code == 200
+    retry = client.put(f"/upload/sessions/{upload_id}/chunk?offset=0", data=data[:half])
+    assert retry.status_code == 409
+    assert retry.get_json()["received_bytes"] == half
+    assert client.put(f"/upload/sessions/{upload_id}/chunk?offset={half}", data=data[half:]).status_code == 200
+
+    with open(f"temp/{upload_id}.xml", "rb") as f:
+        assert f.read() == data
+
+
+def test_complete_rejects_second_ingest_while_first_is_live(client):
+    upload_session = UploadSession(id="b" * 32, total_size=1, received_bytes=1, status="ingesting")
+    db.session.add(upload_session)
+    db.session.commit()
+
+    response = client.post(f"/upload/sessions/{upload_session.id}/complete")
+    assert response.status_code == 409
+    assert response.get_json()["status"] == "ingesting"
+
+
+def test_ingest_keeps_non_ascii_and_quoted_values(app, write_export):
+    path = write_export([{
+        "type": "HKQuantityTypeIdentifierStepCount",
+        "sourceName": "Sam’s Apple Watch",
+        "sourceVersion": "",
+        "device": '<<HKDevice>, name:"Apple Watch", model:Watch, Ünïcode>',
+        "unit": "count",
+        "value": 42,
+        "startDate": "2024-03-01 08:00:00 +0100",
+        "endDate": "2024-03-01 08:05:00 +0100",
+    }])
+
+    assert ingest_xml(path) == 1
+
+    record = Record.query.one()
+    assert record.source_name == "Sam’s Apple Watch"
+    assert record.source_version == ""
+    assert record.device == '<<HKDevice>, name:"Apple Watch", model:Watch, Ünïcode>'
+    assert record.creation_date is None
+
+
+def test_failed_sleep_rebuild_fails_the_ingest_until_resumed(app, write_export, monkeypatch):
+    path = write_export([{
+        "type": SLEEP_TYPE, "sourceName": "Watch", "value": "HKCategoryValueSleepAnalysisAsleepCore",
+        "startDate": "2024-03-01 23:00:00 -0700", "endDate": "2024-03-02 06:00:00 -0700",
+    }])
+    upload_session = UploadSession(id="c" * 32, total_size=1, received_bytes=1, status="ingesting")
+    db.session.add(upload_session)
+    db.session.commit()
+    os.makedirs("temp", exist_ok=True)
+    os.replace(path, f"temp/{upload_session.id}.xml")
+
+    rebuild = routes.upload.rebuild_sleep_sessions
+
+    def failing_rebuild(nights):
+        raise RuntimeError("rebuild failed")
+
+    monkeypatch.setattr(routes.upload, "rebuild_sleep_sessions", failing_rebuild)
+    _run_ingest(app, upload_session.id)
+    db.session.rollback()  # End this session's snapshot to see the ingest's commits
+    assert upload_session.status == "failed"
+    assert SleepSession.query.count() == 0
+
+    monkeypatch.setattr(routes.upload, "rebuild_sleep_sessions", rebuild)
+    _run_ingest(app, upload_session.id)
+    db.session.rollback()
+    assert upload_session.status == "complete"
+    assert SleepSession.query.one().asleep_minutes == 420
+    assert Record.query.count() == 1
+
+
+def test_complete_resets_a_session_whose_temp_file_was_lost(client):
+    upload_session = UploadSession(id="d" * 32, total_size=100, received_bytes=100, status="failed")
+    db.session.add(upload_session)
+    db.session.commit()
+
+    response = client.post(f"/upload/sessions/{upload_session.id}/complete")
+    assert response.status_code == 409
+    assert response.get_json()["status"] == "uploading"
+    assert response.get_json()["received_bytes"] == 0
+
+
+def test_creating_a_session_expires_abandoned_ones(client):
+    stale = datetime.utcnow() - UPLOAD_SESSION_EXPIRY - timedelta(hours=1)
+    for upload_id, status in (("e" * 32, "uploading"), ("f" * 32, "failed"), ("1" * 32, "complete")):
+        db.session.add(UploadSession(id=upload_id, total_size=1, status=status, updated_at=stale))
+    db.session.add(UploadSession(id="2" * 32, total_size=1, status="uploading"))
+    db.session.commit()
+    os.makedirs("temp", exist_ok=True)
+    open(f"temp/{'e' * 32}.xml", "wb").close()
+
+    response = client.post("/upload/sessions", json={"filename": "export.xml", "total_size": 10})
+    assert response.status_code == 201
+
+    db.session.rollback()
+    remaining = {upload_session.id for upload_session in UploadSession.query}
+    assert remaining == {"1" * 32, "2" * 32, response.get_json()["upload_id"]}
+    assert not os.path.exists(f"temp/{'e' * 32}.xml")
+
+
+def test_stop_ingests_fails_running_ingests(app, write_export, monkeypatch):
+    monkeypatch.setattr(routes.upload, "_shutdown", threading.Event())
+    monkeypatch.setattr(routes.upload, "_ingest_threads", {})
+    upload_session = UploadSession(id="3" * 32, total_size=1, received_bytes=1, status="ingesting")
+    db.session.add(upload_session)
+    db.session.commit()
+
+    # An ingest stuck between batches past the join timeout
+    release = threading.Event()
+    thread = threading.Thread(target=release.wait)
+    thread.start()
+    routes.upload._ingest_threads[upload_session.id] = thread
+    try:
+        routes.upload.stop_ingests(timeout=0.1)
+    finally:
+        release.set()
+        thread.join()
+
+    db.session.rollback()
+    assert upload_session.status == "failed"
+    assert upload_session.error == "Worker exited during ingest"
+
+    # Ingests stop at their next batch boundary once the worker is exiting
+    with pytest.raises(RuntimeError):
+        ingest_xml(write_export(heart_rate_records(1000)))
+    db.session.rollback()
+    assert Record.query.count() == 0